@@ -1,17 +1,34 @@
 # Configuración de Modelos de IA
 # Define aquí qué modelo se usa para cada rol específico.
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping, Tuple
 
-AI_CONFIG = {
+@dataclass(frozen=True, slots=True)
+class AIConfig:
     # Cerebro del Árbitro: Encargado de la lógica compleja, física y resolución de conflictos.
-    # Requiere un modelo potente (High Intelligence).
-    "arbitrator_reasoning": "groq/llama-3.3-70b-versatile",
-
-    # Formateador del Árbitro: Encargado de convertir el texto a JSON estricto.
-    # Requiere un modelo rápido y obediente con esquemas (High Speed/Compliance).
-    # "groq/llama-3.1-8b-instant" o modelos Qwen si están disponibles.
-    "arbitrator_formatting": "groq/llama-3.1-8b-instant",
+    # Razona y emite el JSON estricto en una sola llamada (response_format=json_object),
+    # así que requiere un modelo potente (High Intelligence) que soporte modo JSON.
+    arbitrator_reasoning: str = "groq/llama-3.3-70b-versatile"
 
     # Agentes (NPCs): Modelos para los personajes controlados por IA.
     # Deben ser rápidos y capaces de rolear.
-    "agent_default": "groq/llama-3.1-8b-instant"
-}
+    agent_default: str = "groq/llama-3.1-8b-instant"
+
+    # Modelo específico por agente (id de entidad -> modelo). Si no aparece, usa agent_default.
+    # Se guarda como vista de solo lectura (un dict se podría mutar en el global compartido);
+    # queda fuera del hash porque un mappingproxy no es hasheable.
+    agent_models: Mapping[str, str] = field(default_factory=lambda: MappingProxyType({}), hash=False)
+
+    def __post_init__(self):
+        # Copia del dict recibido: ni quien lo pasó puede cambiar la config después
+        object.__setattr__(self, "agent_models", MappingProxyType(dict(self.agent_models)))
+
+    def agent_model(self, agent_id: str) -> str:
+        return self.agent_models.get(agent_id, self.agent_default)
+
+    def all_models(self) -> Tuple[str, ...]:
+        """Todos los modelos configurados, sin repetir (warm-up y Router)."""
+        return tuple(dict.fromkeys([self.arbitrator_reasoning, self.agent_default, *self.agent_models.values()]))
+
+AI_CONFIG = AIConfig()
@@ -1,93 +1,22 @@
-from typing import List, Dict, Any
-import random
-import json
+from typing import List, Dict, Any, Optional
 import os
+import re
+import logging
+import asyncio
+import hashlib
+import jsonpatch
+import orjson
 from abc import ABC, abstractmethod
 from .models import WorldState, AgentAction, TurnResult, WorldChange, Entity
-from litellm import completion
+from .db import DatabaseLog
+from .llm import parse_llm_json, build_system_message, acompletion
+from pydantic import ValidationError
+from litellm import Router
 
-class Arbitrator(ABC):
-    @abstractmethod
-    def resolve_turn(self, state: WorldState, actions: List[AgentAction], turn_id: int, simulation_id: str) -> TurnResult:
-        pass
-
-class LLMArbitrator(Arbitrator):
-    def __init__(self, reasoning_model: str, formatting_model: str):
-        self.reasoning_model = reasoning_model
-        self.formatting_model = formatting_model
-
-    def resolve_turn(self, state: WorldState, actions: List[AgentAction], turn_id: int, simulation_id: str) -> TurnResult:
-        # 1. Preparar Contexto
-        context_str = self._build_context(state, actions)
-        
-        # 2. Llamada 1: Razonamiento (Thinking)
-        print(f"   [LLM] Razonando turno {turn_id}...")
-        reasoning_response = completion(
-            model=self.reasoning_model,
-            messages=[
-                {"role": "system", "content": self._get_system_prompt_reasoning()},
-                {"role": "user", "content": context_str}
-            ]
-        )
-        reasoning_content = reasoning_response.choices[0].message.content
-        # print(f"   [DEBUG-LLM] Reasoning: {reasoning_content[:100]}...")
-
-        # 3. Llamada 2: Formateo (Formatting)
-        print(f"   [LLM] Formateando resultado...")
-        formatting_response = completion(
-            model=self.formatting_model, 
-            messages=[
-                {"role": "system", "content": self._get_system_prompt_formatting()},
-                {"role": "user", "content": f"CONTEXTO ORIGINAL:\n{context_str}\n\nTU RAZONAMIENTO:\n{reasoning_content}\n\nGenera AHORA el JSON válido."}
-            ],
-            response_format={ "type": "json_object" }
-        )
-        formatted_content = formatting_response.choices[0].message.content
-        
-        try:
-            # Limpiar posible markdown ```json ... ```
-            clean_json = formatted_content.replace("```json", "").replace("```", "").strip()
-            result_dict = json.loads(clean_json)
-            
-            # Asegurar campos mínimos
-            result_dict["turn_id"] = turn_id
-            result_dict["simulation_id"] = simulation_id
-            if "world_state" not in result_dict:
-                # Fallback horrible si la IA falla catastróficamente
-                result_dict["world_state"] = state.model_dump()
-            
-            return TurnResult(**result_dict)
-            
-        except json.JSONDecodeError as e:
-            print(f"ERROR JSON LLM: {e}")
-            print(formatted_content)
-            # Fallback de emergencia
-            return TurnResult(
-                turn_id=turn_id,
-                simulation_id=simulation_id,
-                narrative="La realidad se quebró (Error de la IA).",
-                changes=[],
-                events=["error_ai"],
-                world_state=state
-            )
-
-    def _build_context(self, state: WorldState, actions: List[AgentAction]) -> str:
-        actions_desc = []
-        for a in actions:
-            target_str = f" sobre {a.target_id}" if a.target_id else ""
-            payload_str = f" ({a.payload})" if a.payload else ""
-            actions_desc.append(f"- Agente {a.agent_id} intenta {a.action_type}{target_str}{payload_str}")
-        
-        return f"""
-ESTADO ACTUAL DEL MUNDO:
-{state.model_dump_json(indent=2)}
-
-ACCIONES PROPUESTAS POR LOS AGENTES:
-{chr(10).join(actions_desc)}
-"""
+logger = logging.getLogger(__name__)
 
-    def _get_system_prompt_reasoning(self) -> str:
-        return """
+# Prompts del sistema: constantes de módulo, se construyen una sola vez al importar.
+_SYS_REASONING = """
 Eres el Árbitro (Motor Físico) de la simulación Project Sandbox.
 Tu trabajo es decidir fríamente qué sucede basándote en la lógica y los atributos.
 
@@ -103,19 +32,11 @@ REGLAS DE NARRATIVA (IMPORTANTE):
 - Evita metáforas, drama innecesario o leer la mente de los personajes ("sintió resignación").
 - Céntrate en lo que se ve desde fuera.
 
-Tu salida debe ser un análisis paso a paso de lo que ocurre.
-"""
-
-    def _get_system_prompt_formatting(self) -> str:
-        return """
-Eres un formateador de datos JSON.
-Tu tarea:
-1. Extrae los CAMBIOS exactos (CREATE/UPDATE/DELETE) del razonamiento.
-2. Genera un resumen narrativo de UNA sola frase para el campo "narrative".
-3. Devuelve el JSON válido que cumpla con el esquema `TurnResult`.
-
-El esquema es:
+FORMATO DE SALIDA:
+Responde SOLO con un objeto JSON válido con este esquema. Rellena primero
+"reasoning" con tu análisis paso a paso y después el resto de campos a partir de él.
 {
+  "reasoning": "Análisis paso a paso de lo que ocurre.",
   "narrative": "Resumen de UNA sola frase.",
   "changes": [
     {
@@ -127,15 +48,312 @@ El esquema es:
     }
   ],
   "events": ["string (etiquetas, ej: 'conflict_resolved')"],
-  "world_state": { ... objeto WorldState completo actualizado ... }
+  "world_patch": [
+    {"op": "test", "path": "/entities/2/id", "value": "agent_juan"},
+    {"op": "replace", "path": "/entities/2/attributes/hambre", "value": 5},
+    {"op": "test", "path": "/entities/0/id", "value": "item_bocadillo"},
+    {"op": "remove", "path": "/entities/0"}
+  ]
 }
 
 IMPORTANTE: 
 - `changes` debe ser una LISTA DE OBJETOS, NO strings. Si no hay cambios de datos, pon [].
-- Debes devolver el `world_state` COMPLETO.
-- Responde SOLO con el JSON.
+- NO repitas el estado completo. `world_patch` es un JSON Patch (RFC 6902) que, aplicado
+  sobre el ESTADO ACTUAL recibido, produce el estado tras el turno. Si nada cambia, pon [].
+- Las rutas usan el índice de la entidad en la lista `entities` (empezando en 0).
+  Las operaciones se aplican en orden: pon los "remove" al final, de mayor a menor índice.
+- ANTES de cada operación sobre una entidad pon un {"op": "test", "path": "/entities/N/id",
+  "value": "<id de esa entidad>"} que confirme que el índice N es el correcto.
+"""
+
+# Huella del prompt para la clave de la caché de turnos: si se edita, las entradas antiguas dejan de acertar
+_SYS_REASONING_DIGEST = hashlib.blake2b(_SYS_REASONING.encode(), digest_size=16).digest()
+
+_SYS_MULTI_TURN = _SYS_REASONING + """
+MODO MULTI-TURNO:
+Recibirás el estado inicial y las acciones de VARIOS turnos consecutivos.
+Resuélvelos EN ORDEN: el `world_patch` de cada turno se aplica sobre el estado resultante
+del turno anterior (el del turno 1, sobre el estado inicial).
+Responde SOLO con un objeto JSON de la forma:
+{
+  "turns": [ { ...objeto con el esquema anterior para el turno 1... }, { ...turno 2... } ]
+}
+Debe haber EXACTAMENTE un objeto por turno recibido.
+"""
+
+# Campo "narrative" ya cerrado dentro del JSON que se está recibiendo en streaming
+_NARRATIVE_RE = re.compile(r'"narrative"\s*:\s*"((?:[^"\\]|\\.)*)"')
+# Lo que sigue a un "narrative" encontrado: si hay ":" es la clave, si no, era un valor
+_KEY_COLON_RE = re.compile(r'\s*(:)?')
+
+class Arbitrator(ABC):
+    @abstractmethod
+    async def aresolve_turn(self, state: WorldState, actions: List[AgentAction], turn_id: int, simulation_id: str) -> TurnResult:
+        pass
+
+    async def aresolve_turns(self, state: WorldState, actions_per_turn: List[List[AgentAction]], first_turn_id: int, simulation_id: str) -> List[TurnResult]:
+        """
+        Resuelve varios turnos consecutivos con acciones ya conocidas.
+        Por defecto los encadena uno a uno: el world_state de cada turno es la entrada del siguiente.
+        """
+        results: List[TurnResult] = []
+        for offset, actions in enumerate(actions_per_turn):
+            result = await self.aresolve_turn(state, actions, first_turn_id + offset, simulation_id)
+            results.append(result)
+            state = result.world_state
+        return results
+
+class LLMArbitrator(Arbitrator):
+    def __init__(self, reasoning_model: str, db: Optional[DatabaseLog] = None, router: Optional[Router] = None):
+        self.reasoning_model = reasoning_model
+        self.router = router
+        # Caché de turnos: mismo (estado, acciones) -> mismo resultado, sin llamar al LLM.
+        # ARBITRATOR_CACHE=off la desactiva si se quiere no-determinismo.
+        self.db = db
+        self.cache_enabled = db is not None and os.getenv("ARBITRATOR_CACHE", "on").lower() != "off"
+        # Streaming: la narrativa se guarda en la DB mientras el modelo sigue generando el resto.
+        # ARBITRATOR_STREAM=off vuelve a la llamada única con response_format=json_object.
+        self.stream_enabled = os.getenv("ARBITRATOR_STREAM", "on").lower() != "off"
+        # Prefijo estático: el mensaje de sistema se construye una sola vez y se reutiliza,
+        # idéntico byte a byte en cada turno para que el prefix caching (Groq/OpenAI) acierte.
+        self._reasoning_sys_msg = build_system_message(reasoning_model, _SYS_REASONING)
+        self._multi_turn_sys_msg = build_system_message(reasoning_model, _SYS_MULTI_TURN)
+
+    async def aresolve_turn(self, state: WorldState, actions: List[AgentAction], turn_id: int, simulation_id: str) -> TurnResult:
+        # 0. Consultar caché
+        input_hash = None
+        if self.cache_enabled:
+            input_hash = self._input_hash(state, actions)
+            cached_json = self.db.get_cached_turn(input_hash)
+            if cached_json:
+                logger.info(f"   [LLM] Turno {turn_id} servido desde caché.")
+                cached = TurnResult.model_validate_json(cached_json)
+                return cached.model_copy(update={"turn_id": turn_id, "simulation_id": simulation_id})
+
+        # 1. Preparar Contexto
+        context_str = self._build_context(state, actions)
+        
+        # 2. Llamada única: el modelo razona y emite el JSON en la misma respuesta
+        logger.info(f"   [LLM] Resolviendo turno {turn_id}...")
+        messages = self._build_messages(self._reasoning_sys_msg, context_str)
+        partial_task = None
+        if self.stream_enabled:
+            content, partial_task = await self._stream_completion(messages, turn_id, simulation_id)
+        else:
+            response = await acompletion(
+                router=self.router,
+                model=self.reasoning_model,
+                messages=messages,
+                response_format={ "type": "json_object" }
+            )
+            content = response.choices[0].message.content
+        
+        if partial_task:
+            # El guardado parcial debe terminar antes de que el engine escriba el turno completo
+            try:
+                await partial_task
+            except Exception as e:
+                logger.error(f"ERROR guardado parcial turno {turn_id}: {e}")
+        
+        try:
+            result_dict = parse_llm_json(content)
+            result = self._build_result(result_dict, state, turn_id, simulation_id)
+            
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            # JSON inválido o que no cumple el esquema (ValidationError es un ValueError)
+            logger.error(f"ERROR JSON LLM: {e}\n{content}")
+            # Fallback de emergencia
+            return TurnResult(
+                turn_id=turn_id,
+                simulation_id=simulation_id,
+                narrative="La realidad se quebró (Error de la IA).",
+                changes=[],
+                events=["error_ai"],
+                world_state=state
+            )
+
+        # Solo se cachean respuestas válidas, nunca el fallback de error
+        if input_hash:
+            self.db.save_cached_turn(input_hash, result.model_dump_json())
+        return result
+
+    async def aresolve_turns(self, state: WorldState, actions_per_turn: List[List[AgentAction]], first_turn_id: int, simulation_id: str) -> List[TurnResult]:
+        # Todas las acciones se conocen de antemano (drivers deterministas): una sola
+        # llamada resuelve los N turnos encadenados en vez de N llamadas secuenciales.
+        if len(actions_per_turn) <= 1:
+            return await super().aresolve_turns(state, actions_per_turn, first_turn_id, simulation_id)
+
+        context_str = self._build_multi_turn_context(state, actions_per_turn)
+        
+        logger.info(f"   [LLM] Resolviendo turnos {first_turn_id}-{first_turn_id + len(actions_per_turn) - 1} en una llamada...")
+        response = await acompletion(
+            router=self.router,
+            model=self.reasoning_model,
+            messages=self._build_messages(self._multi_turn_sys_msg, context_str),
+            response_format={ "type": "json_object" }
+        )
+        content = response.choices[0].message.content
+        
+        try:
+            turns = parse_llm_json(content)["turns"]
+            if len(turns) != len(actions_per_turn):
+                raise ValueError(f"se esperaban {len(actions_per_turn)} turnos, llegaron {len(turns)}")
+            
+            results: List[TurnResult] = []
+            for offset, result_dict in enumerate(turns):
+                # Cada parche se aplica sobre el estado resultante del turno anterior
+                base_state = results[-1].world_state if results else state
+                results.append(self._build_result(result_dict, base_state, first_turn_id + offset, simulation_id))
+            return results
+            
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.error(f"ERROR JSON LLM (multi-turno): {e}. Resolviendo turno a turno.")
+            return await super().aresolve_turns(state, actions_per_turn, first_turn_id, simulation_id)
+
+    async def _stream_completion(self, messages: List[Dict[str, Any]], turn_id: int, simulation_id: str):
+        # Sin response_format: el modo JSON de Groq no admite streaming. El prompt ya exige
+        # solo JSON y parse_llm_json rescata el objeto si llega envuelto en texto.
+        response = await acompletion(
+            router=self.router,
+            model=self.reasoning_model,
+            messages=messages,
+            stream=True
+        )
+        
+        content = ""
+        partial_task = None
+        watch_narrative = self.db is not None
+        # El buffer solo crece: la clave se busca a partir de lo ya revisado (reasoning llega
+        # primero y puede ser largo) y, una vez encontrada, se ancla el regex en ella.
+        key_pos = -1
+        scan_from = 0
+        async for chunk in response:
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            content += delta
+            
+            # En cuanto se cierra "narrative", se guarda en segundo plano (el resto sigue llegando)
+            while watch_narrative:
+                if key_pos < 0:
+                    key_pos = content.find('"narrative"', scan_from)
+                    if key_pos < 0:
+                        # La clave puede quedar partida entre dos deltas
+                        scan_from = max(scan_from, len(content) - len('"narrative"') + 1)
+                        break
+                after_key = key_pos + len('"narrative"')
+                colon = _KEY_COLON_RE.match(content, after_key)
+                if colon.group(1) is None:
+                    if colon.end() == len(content):
+                        break  # Aún no se sabe si es la clave: esperar al siguiente delta
+                    # Era un valor (p. ej. "events": ["narrative"]), no la clave: buscar detrás
+                    key_pos = -1
+                    scan_from = after_key
+                    continue
+                match = _NARRATIVE_RE.match(content, key_pos)
+                if not match:
+                    break  # Valor aún incompleto
+                watch_narrative = False
+                try:
+                    narrative = orjson.loads(f'"{match.group(1)}"')
+                except orjson.JSONDecodeError as e:
+                    # Escape inválido: sin guardado parcial, el JSON completo decidirá
+                    logger.error(f"ERROR narrativa parcial turno {turn_id}: {e}")
+                    break
+                partial_task = asyncio.create_task(asyncio.to_thread(
+                    self.db.save_turn_partial, turn_id, simulation_id, narrative
+                ))
+        return content, partial_task
+
+    def _build_result(self, result_dict: Dict[str, Any], base_state: WorldState, turn_id: int, simulation_id: str) -> TurnResult:
+        # El razonamiento solo sirve para que el modelo piense antes de decidir
+        result_dict.pop("reasoning", None)
+        world_state = self._resolve_world_state(base_state, result_dict)
+        
+        # Solo se valida lo que genera el LLM (changes, world_state); el envoltorio
+        # TurnResult se construye directamente con datos que ya son de confianza.
+        return TurnResult.model_construct(
+            turn_id=turn_id,
+            simulation_id=simulation_id,
+            narrative=str(result_dict.get("narrative", "")),
+            changes=[WorldChange.model_validate(c) for c in result_dict.get("changes") or []],
+            events=[str(e) for e in result_dict.get("events") or []],
+            world_state=world_state
+        )
+
+    def _resolve_world_state(self, base_state: WorldState, result_dict: Dict[str, Any]) -> WorldState:
+        # El modelo devuelve solo el delta (RFC-6902) en vez de repetir el WorldState
+        # completo: muchos menos tokens de salida en mundos estables.
+        patch = result_dict.pop("world_patch", None)
+        if patch is not None:
+            # Aplicar y validar van juntos: un parche que aplica bien puede dejar un estado inválido
+            try:
+                if not isinstance(patch, list):
+                    raise ValueError(f"world_patch debe ser una lista de operaciones, no {type(patch).__name__}")
+                return WorldState.model_validate(jsonpatch.apply_patch(base_state.model_dump(), patch))
+            except (jsonpatch.JsonPatchException, jsonpatch.JsonPointerException, TypeError, ValueError, ValidationError) as e:
+                logger.error(f"ERROR PATCH LLM: {e}")
+                # "events" puede venir null o ausente: no depender de que sea una lista
+                result_dict["events"] = [*(result_dict.get("events") or []), "error_patch"]
+                return base_state
+        
+        if "world_state" in result_dict:
+            # Compatibilidad: el modelo ignoró el protocolo y mandó el estado completo
+            return WorldState.model_validate(result_dict["world_state"])
+        
+        # Fallback horrible si la IA falla catastróficamente
+        return base_state
+
+    def _input_hash(self, state: WorldState, actions: List[AgentAction]) -> str:
+        actions_json = orjson.dumps(
+            [a.model_dump() for a in sorted(actions, key=lambda x: x.agent_id)],
+            option=orjson.OPT_SORT_KEYS
+        )
+        # La caché vive en la DB entre ejecuciones: el modelo y el prompt forman parte de la clave
+        key = hashlib.blake2b(self.reasoning_model.encode() + b"\0" + _SYS_REASONING_DIGEST)
+        key.update(state.model_dump_json().encode())
+        key.update(actions_json)
+        return key.hexdigest()
+
+    def _build_messages(self, system_msg: Dict[str, Any], context_str: str) -> List[Dict[str, Any]]:
+        # ORDEN IMPORTANTE: todo lo invariante va primero (system) y lo que cambia cada
+        # turno (estado + acciones) va SOLO al final, en el mensaje de usuario.
+        # No anteponer contenido dinámico al prompt del sistema o se rompe la caché de prefijo.
+        return [
+            system_msg,
+            {"role": "user", "content": context_str}
+        ]
+
+    def _build_context(self, state: WorldState, actions: List[AgentAction]) -> str:
+        return f"""
+ESTADO ACTUAL DEL MUNDO:
+{state.model_dump_json()}
+
+ACCIONES PROPUESTAS POR LOS AGENTES:
+{self._describe_actions(actions)}
+"""
+
+    def _build_multi_turn_context(self, state: WorldState, actions_per_turn: List[List[AgentAction]]) -> str:
+        turns_desc = []
+        for offset, actions in enumerate(actions_per_turn, start=1):
+            turns_desc.append(f"TURNO {offset}:\n{self._describe_actions(actions)}")
+        
+        return f"""
+ESTADO INICIAL DEL MUNDO:
+{state.model_dump_json()}
+
+ACCIONES PROPUESTAS POR LOS AGENTES, TURNO A TURNO:
+{chr(10).join(turns_desc)}
 """
 
+    def _describe_actions(self, actions: List[AgentAction]) -> str:
+        actions_desc = []
+        for a in actions:
+            target_str = f" sobre {a.target_id}" if a.target_id else ""
+            payload_str = f" ({a.payload})" if a.payload else ""
+            actions_desc.append(f"- Agente {a.agent_id} intenta {a.action_type}{target_str}{payload_str}")
+        return chr(10).join(actions_desc)
+
 class MockArbitrator(Arbitrator):
     """
     Reemplaza al Árbitro LLM para el MVP.
@@ -143,18 +361,20 @@ class MockArbitrator(Arbitrator):
     Ahora soporta RESOLUCIÓN DE CONFLICTOS.
     """
     
-    def resolve_turn(self, state: WorldState, actions: List[AgentAction], turn_id: int, sim_id: str) -> TurnResult:
+    async def aresolve_turn(self, state: WorldState, actions: List[AgentAction], turn_id: int, sim_id: str) -> TurnResult:
         changes: List[WorldChange] = []
         events: List[str] = []
         narrative_lines: List[str] = []
         
-        current_entities = {e.id: e for e in state.entities}
+        # Índices por id construidos una vez por turno (evita búsquedas O(n) en los bucles)
+        by_id = {e.id: e for e in state.entities}
+        names = {e.id: e.name for e in state.entities}
         
         # 1. Agrupar acciones por tipo/objetivo para detectar conflictos
         take_requests: Dict[str, List[str]] = {} # item_id -> [agent_id, ...]
         
         for action in actions:
-            agent_name = next((e.name for e in state.entities if e.id == action.agent_id), action.agent_id)
+            agent_name = names.get(action.agent_id, action.agent_id)
             
             if action.action_type == "TALK":
                  msg = action.payload.get("message", "...")
@@ -171,26 +391,27 @@ class MockArbitrator(Arbitrator):
 
         # 2. Resolver conflictos de TAKE
         for item_id, agents in take_requests.items():
-            item = current_entities.get(item_id)
+            item = by_id.get(item_id)
             if not item:
                 continue
 
             if len(agents) == 1:
                 # Éxito
                 winner_id = agents[0]
-                winner_name = next((e.name for e in state.entities if e.id == winner_id), winner_id)
-                self._apply_take_success(winner_id, winner_name, item, changes, narrative_lines, events, state)
+                winner_name = names.get(winner_id, winner_id)
+                self._apply_take_success(winner_id, winner_name, item, changes, narrative_lines, events, by_id)
             else:
-                # ¡Conflicto!
-                winner_id = random.choice(agents)
-                winner_name = next((e.name for e in state.entities if e.id == winner_id), winner_id)
-                losers = [a for a in agents if a != winner_id]
-                losers_names = [next((e.name for e in state.entities if e.id == a), a) for a in losers]
+                # ¡Conflicto! Orden determinista por hash de (turno, objeto, agente):
+                # simulaciones reproducibles y sin depender del estado global de `random`
+                agents.sort(key=lambda a: hashlib.blake2b(f"{turn_id}|{item_id}|{a}".encode(), digest_size=8).digest())
+                winner_id, *losers = agents
+                winner_name = names.get(winner_id, winner_id)
+                losers_names = [names.get(a, a) for a in losers]
                 
                 narrative_lines.append(f"¡CONFLICTO! {', '.join(losers_names)} y {winner_name} pelean por el objeto {item.name}.")
                 narrative_lines.append(f"¡{winner_name} empuja a los demás y lo agarra!")
                 
-                self._apply_take_success(winner_id, winner_name, item, changes, narrative_lines, events, state)
+                self._apply_take_success(winner_id, winner_name, item, changes, narrative_lines, events, by_id)
                 events.append("conflict_occurred")
 
         # Apply changes to generate the new state snapshot
@@ -205,7 +426,7 @@ class MockArbitrator(Arbitrator):
             world_state=new_state
         )
 
-    def _apply_take_success(self, agent_id: str, agent_name: str, item: Entity, changes: List[WorldChange], narrative: List[str], events: List[str], state: WorldState):
+    def _apply_take_success(self, agent_id: str, agent_name: str, item: Entity, changes: List[WorldChange], narrative: List[str], events: List[str], by_id: Dict[str, Entity]):
         # 1. Remove item from world entities
         changes.append(WorldChange(
             action='DELETE',
@@ -214,10 +435,11 @@ class MockArbitrator(Arbitrator):
         
         # 2. Update agent inventory
         # Find agent current attributes to modify
-        agent = next((e for e in state.entities if e.id == agent_id), None)
+        agent = by_id.get(agent_id)
         if agent:
             new_attrs = agent.attributes.copy()
-            inventory = new_attrs.get("inventario", [])
+            # Lista nueva: no mutar el inventario del estado anterior (que sigue en memoria)
+            inventory = list(new_attrs.get("inventario", []))
             inventory.append(item.id)
             new_attrs["inventario"] = inventory
             
@@ -233,22 +455,20 @@ class MockArbitrator(Arbitrator):
         events.append(f"{agent_id}_took_{item.id}")
 
     def _apply_changes(self, state: WorldState, changes: List[WorldChange]) -> WorldState:
-        # Deep copy
-        new_entities = [e.model_copy() for e in state.entities]
+        # Turno sin cambios: los estados nunca se mutan, así que se reutiliza el mismo
+        if not changes:
+            return state
+        
+        # Copy-on-write: solo se copian las entidades tocadas, el resto se comparte con el estado anterior
+        # Dict por id (mantiene el orden de inserción) en vez de reconstruir la lista en cada DELETE
+        new_entities = {e.id: e for e in state.entities}
         
         for change in changes:
             if change.action == 'DELETE':
-                new_entities = [e for e in new_entities if e.id != change.entity_id]
-            elif change.action == 'UPDATE':
-                for e in new_entities:
-                    if e.id == change.entity_id:
-                        if change.attribute == 'attributes':
-                            e.attributes = change.value_new
+                new_entities.pop(change.entity_id, None)
+            elif change.action == 'UPDATE' and change.attribute == 'attributes':
+                e = new_entities.get(change.entity_id)
+                if e:
+                    new_entities[change.entity_id] = e.model_copy(update={"attributes": change.value_new})
                         
-        return WorldState(
-            room_id=state.room_id,
-            turn_mode=state.turn_mode,
-            agent_timeout_seconds=state.agent_timeout_seconds,
-            environment=state.environment,
-            entities=new_entities
-        )
+        return state.model_copy(update={"entities": list(new_entities.values())})
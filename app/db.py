@@ -1,7 +1,9 @@
 import sqlite3
-import json
+import orjson
 import logging
-from typing import Optional, Dict, Any
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator
 from .models import WorldState, TurnResult
 
 logger = logging.getLogger(__name__)
@@ -9,11 +11,35 @@ logger = logging.getLogger(__name__)
 class DatabaseLog:
     def __init__(self, db_path: str = "simulation.db"):
         self.db_path = db_path
+        # Una sola conexión por instancia (en vez de abrir una por llamada).
+        # isolation_level=None -> autocommit; las escrituras múltiples usan _transaction().
+        # check_same_thread=False porque save_turn se ejecuta en un hilo (asyncio.to_thread);
+        # el acceso se serializa con self._lock.
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute("PRAGMA temp_store=MEMORY;")
+        self._conn.execute("PRAGMA mmap_size=268435456;")
         self._init_db()
 
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
     def _init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("PRAGMA journal_mode=WAL;")
+        with self._transaction() as conn:
             # Simulation config table
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS simulations (
@@ -29,13 +55,26 @@ class DatabaseLog:
                     turn_id INTEGER,
                     simulation_id TEXT,
                     agents_inputs TEXT,
-                    referee_decision TEXT, 
+                    referee_decision TEXT,
                     world_state TEXT,
                     status TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     PRIMARY KEY (turn_id, simulation_id)
                 )
             """)
+            # La PK empieza por turn_id: sin este índice, buscar por simulación recorre toda la tabla
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_turnlogs_sim_turn
+                ON turn_logs(simulation_id, turn_id DESC)
+            """)
+            # Último estado de cada simulación (lectura por PK, sin ORDER BY sobre turn_logs)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS latest_state (
+                    simulation_id TEXT PRIMARY KEY,
+                    world_state TEXT,
+                    turn_id INTEGER
+                )
+            """)
             # Events table (for semantic search)
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS events (
@@ -46,51 +85,117 @@ class DatabaseLog:
                     entity_id TEXT
                 )
             """)
+            # Turn cache (exact match of state + actions -> TurnResult del árbitro)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS turn_cache (
+                    input_hash TEXT PRIMARY KEY,
+                    result_json TEXT
+                )
+            """)
 
     def create_simulation(self, sim_id: str, config: Dict[str, Any]):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
+        with self._lock:
+            self._conn.execute(
                 "INSERT INTO simulations (id, config_json, status) VALUES (?, ?, ?)",
-                (sim_id, json.dumps(config), "running")
+                (sim_id, orjson.dumps(config).decode(), "running")
             )
 
     def load_last_state(self, sim_id: str) -> Optional[Dict[str, Any]]:
         """Returns the world state from the last completed turn, or None if new."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute(
-                "SELECT world_state FROM turn_logs WHERE simulation_id = ? ORDER BY turn_id DESC LIMIT 1",
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT world_state FROM latest_state WHERE simulation_id = ?",
+                (sim_id,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                # Simulaciones guardadas antes de existir latest_state
+                cursor = self._conn.execute(
+                    "SELECT world_state FROM turn_logs WHERE simulation_id = ? AND status = 'completed' ORDER BY turn_id DESC LIMIT 1",
+                    (sim_id,)
+                )
+                row = cursor.fetchone()
+        if row:
+            return orjson.loads(row[0])
+        return None
+
+    def get_last_turn_id(self, sim_id: str) -> Optional[int]:
+        """Returns the highest completed turn_id for the simulation, or None if it has no turns."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT MAX(turn_id) FROM turn_logs WHERE simulation_id = ? AND status = 'completed'",
                 (sim_id,)
             )
             row = cursor.fetchone()
-            if row:
-                return json.loads(row[0])
-            return None
+        return row[0]
 
     def save_turn(self, turn_result: TurnResult, inputs: Dict[str, Any]):
-        with sqlite3.connect(self.db_path) as conn:
+        world_state_json = turn_result.world_state.model_dump_json()
+        # Log principal + eventos en una única transacción (un solo commit/fsync por turno)
+        with self._transaction() as conn:
             # Save main log
             conn.execute(
                 """
-                INSERT INTO turn_logs 
+                INSERT INTO turn_logs
                 (turn_id, simulation_id, agents_inputs, referee_decision, world_state, status)
                 VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (turn_id, simulation_id) DO UPDATE SET
+                    agents_inputs = excluded.agents_inputs,
+                    referee_decision = excluded.referee_decision,
+                    world_state = excluded.world_state,
+                    status = excluded.status
                 """,
                 (
                     turn_result.turn_id,
                     turn_result.simulation_id,
-                    json.dumps(inputs),
-                    json.dumps({
-                        "narrative": turn_result.narrative,
-                        "changes": [c.model_dump() for c in turn_result.changes]
-                    }),
-                    turn_result.world_state.model_dump_json(),
+                    orjson.dumps(inputs).decode(),
+                    # Serializador nativo de Pydantic (Rust) directo a JSON, sin dicts intermedios
+                    turn_result.model_dump_json(include={"narrative", "changes"}),
+                    world_state_json,
                     "completed"
                 )
             )
-            
+
+            conn.execute(
+                "INSERT OR REPLACE INTO latest_state (simulation_id, world_state, turn_id) VALUES (?, ?, ?)",
+                (turn_result.simulation_id, world_state_json, turn_result.turn_id)
+            )
+
             # Index events
-            for event in turn_result.events:
-                conn.execute(
-                    "INSERT INTO events (simulation_id, turn_id, event_tag) VALUES (?, ?, ?)",
-                    (turn_result.simulation_id, turn_result.turn_id, event)
-                )
+            conn.executemany(
+                "INSERT INTO events (simulation_id, turn_id, event_tag) VALUES (?, ?, ?)",
+                [(turn_result.simulation_id, turn_result.turn_id, event) for event in turn_result.events]
+            )
+
+    def save_turn_partial(self, turn_id: int, sim_id: str, narrative: str):
+        """Guarda la narrativa de un turno aún en curso; save_turn la completa después."""
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO turn_logs (turn_id, simulation_id, referee_decision, status)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (turn_id, simulation_id) DO UPDATE SET
+                    referee_decision = excluded.referee_decision,
+                    status = excluded.status
+                """,
+                (turn_id, sim_id, orjson.dumps({"narrative": narrative, "changes": []}).decode(), "partial")
+            )
+
+    def get_cached_turn(self, input_hash: str) -> Optional[str]:
+        """Returns the cached TurnResult JSON for this input hash, or None on miss."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT result_json FROM turn_cache WHERE input_hash = ?",
+                (input_hash,)
+            )
+            row = cursor.fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def save_cached_turn(self, input_hash: str, result_json: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO turn_cache (input_hash, result_json) VALUES (?, ?)",
+                (input_hash, result_json)
+            )
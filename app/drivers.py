@@ -1,12 +1,27 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from .models import WorldState, TurnResult, AgentAction
+from .llm import parse_llm_json, build_system_message, acompletion
 import random
 import asyncio
 import json
 import os
+import sys
+import threading
+from collections import deque
+import logging
+import logging.handlers
+import orjson
+from pydantic import ValidationError
+from litellm import Router, batch_completion
+
+logger = logging.getLogger(__name__)
 
 class BaseDriver(ABC):
+    # True si get_action no depende del estado visible: sus acciones pueden
+    # precalcularse para varios turnos (ver SimulationEngine.run_steps_batched).
+    deterministic: bool = False
+
     def __init__(self, agent_id: str):
         self.agent_id = agent_id
 
@@ -59,35 +74,189 @@ class MockAIDriver(BaseDriver):
 
 class APIDriver(BaseDriver):
     """
-    Esqueleto para futura integración con LLMs reales (Fase 1/2).
+    Agente controlado por un LLM real vía LiteLLM.
+    Si varios APIDriver comparten modelo, el engine los agrupa con batch_get_actions.
     """
-    def __init__(self, agent_id: str, model_name: str = "groq/llama-3.1-8b-instant"):
+    def __init__(self, agent_id: str, model_name: str = "groq/llama-3.1-8b-instant", router: Optional[Router] = None):
         super().__init__(agent_id)
         self.model_name = model_name
+        self.router = router
+        self.last_narrative = ""
+        # El prompt del sistema solo depende del agente: se construye una vez y va primero
+        # (prefijo cacheable); el estado visible del turno va al final, en el mensaje de usuario
+        self._system_msg = build_system_message(model_name, self._get_system_prompt())
     
     async def get_action(self, visible_state: WorldState) -> AgentAction:
-        # TODO: Implementar llamada a API real
-        # Por ahora devuelve WAIT
-        return AgentAction(
-            agent_id=self.agent_id,
-            action_type="WAIT",
-            payload={"reason": "Esperando implementación de API..."}
+        try:
+            response = await acompletion(
+                router=self.router,
+                model=self.model_name,
+                messages=self._build_messages(visible_state),
+                response_format={ "type": "json_object" }
+            )
+        except Exception as e:
+            # Igual que en batch_get_actions: un fallo del proveedor no pierde la acción, el agente espera
+            logger.error(f"ERROR API {self.agent_id}: {e}")
+            return AgentAction(agent_id=self.agent_id, action_type="WAIT", payload={"reason": "error_api"})
+        return self._parse_action(response.choices[0].message.content)
+
+    @classmethod
+    async def batch_get_actions(cls, drivers: List["APIDriver"], visible_state: WorldState) -> List[AgentAction]:
+        """Pide la acción de varios agentes del MISMO modelo en una sola petición batch."""
+        # batch_completion es síncrono (reparte en hilos internamente): no bloquear el event loop.
+        # OJO: va directo a LiteLLM, sin el Router, así que NO tiene sus reintentos ante 429;
+        # un error aquí deja al agente en WAIT ese turno.
+        responses = await asyncio.to_thread(
+            batch_completion,
+            model=drivers[0].model_name,
+            messages=[d._build_messages(visible_state) for d in drivers],
+            response_format={ "type": "json_object" }
         )
+        
+        actions = []
+        for driver, response in zip(drivers, responses):
+            if isinstance(response, Exception):
+                logger.error(f"ERROR API {driver.agent_id}: {response}")
+                actions.append(AgentAction(agent_id=driver.agent_id, action_type="WAIT", payload={"reason": "error_api"}))
+            else:
+                actions.append(driver._parse_action(response.choices[0].message.content))
+        return actions
+
+    def _build_messages(self, visible_state: WorldState) -> List[Dict[str, Any]]:
+        last_turn = self.last_narrative or "(ninguno, es el primer turno)"
+        return [
+            self._system_msg,
+            {"role": "user", "content": f"ESTADO VISIBLE:\n{visible_state.model_dump_json()}\n\nÚLTIMO TURNO:\n{last_turn}"}
+        ]
+
+    def _get_system_prompt(self) -> str:
+        return f"""
+Eres el personaje {self.agent_id} de la simulación Project Sandbox.
+Decide tu próxima acción según el estado visible y tus atributos.
+
+Responde SOLO con un objeto JSON válido con este esquema:
+{{
+  "action_type": "TAKE" | "TALK" | "WAIT",
+  "target_id": "string (opcional, id de la entidad objetivo)",
+  "payload": {{ "message": "string (solo para TALK)" }}
+}}
+"""
+
+    def _parse_action(self, content: str) -> AgentAction:
+        try:
+            action_dict = parse_llm_json(content)
+            return AgentAction(
+                agent_id=self.agent_id,
+                action_type=str(action_dict.get("action_type", "WAIT")).upper(),
+                target_id=action_dict.get("target_id"),
+                payload=action_dict.get("payload") or {}
+            )
+        except (orjson.JSONDecodeError, AttributeError, ValidationError) as e:
+            logger.error(f"ERROR JSON API {self.agent_id}: {e}\n{content}")
+            # Fallback: si la IA no responde bien, el agente espera
+            return AgentAction(agent_id=self.agent_id, action_type="WAIT", payload={"reason": "error_ai"})
 
     async def receive_feedback(self, turn_result: TurnResult):
-        pass
+        self.last_narrative = turn_result.narrative
+
+async def _drain_log_queue(timeout: float = 1.0):
+    """
+    Espera a que el QueueListener (si main.py lo configuró) termine de escribir lo ya encolado.
+    Sin QueueHandler en el logger raíz no hay nada que esperar; el timeout evita colgarse
+    si la cola no tiene un listener activo.
+    """
+    queues = [h.queue for h in logging.getLogger().handlers if isinstance(h, logging.handlers.QueueHandler)]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # El listener llama a task_done() después de escribir cada registro
+    while any(getattr(q, "unfinished_tasks", 0) for q in queues) and loop.time() < deadline:
+        await asyncio.sleep(0.005)
+
+class _StdinBroker:
+    """
+    Lector único de stdin compartido por todos los HumanDriver.
+    Un solo hilo persistente hace readline() (en vez de un hilo por llamada) y las
+    preguntas se atienden de una en una para que los prompts no se mezclen en consola.
+    Las líneas que llegan sin pregunta pendiente (entrada por pipe, teclear por adelantado)
+    se guardan en orden para las preguntas siguientes. Solo se descartan las que llegan
+    entre el timeout de una pregunta y el prompt siguiente: son respuestas a una pregunta caducada.
+    """
+    def __init__(self):
+        self._thread: threading.Thread | None = None
+        self._turn_lock: asyncio.Lock | None = None
+        self._waiter: asyncio.Future | None = None
+        self._lines: deque[str] = deque()
+        self._expired = False
+        self._eof = False
+
+    def _reader(self, loop: asyncio.AbstractEventLoop):
+        while True:
+            line = sys.stdin.readline()
+            try:
+                loop.call_soon_threadsafe(self._deliver, line)
+            except RuntimeError:
+                # El event loop ya se cerró (fin de la simulación)
+                return
+            if not line:
+                return
+
+    def _deliver(self, line: str):
+        # Se ejecuta en el event loop, nunca en el hilo lector
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(line)
+        elif not line:
+            pass
+        elif self._expired:
+            logger.debug(f"Entrada descartada (pregunta caducada): {line.rstrip()}")
+        else:
+            self._lines.append(line)
+        if not line:
+            self._eof = True
+
+    async def ask(self, prompt: str) -> str:
+        loop = asyncio.get_running_loop()
+        if self._turn_lock is None:
+            self._turn_lock = asyncio.Lock()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._reader, args=(loop,), name="stdin-broker", daemon=True)
+            self._thread.start()
+        
+        async with self._turn_lock:
+            self._expired = False
+            # Directo a stdout (no depende de la config de logging), pero después de que se
+            # escriban los mensajes de estado ya encolados, para que no caigan sobre la pregunta
+            await _drain_log_queue()
+            print(prompt, end="", flush=True)
+            if self._lines:
+                return self._lines.popleft()
+            if self._eof:
+                return ""
+            self._waiter = loop.create_future()
+            try:
+                return await self._waiter
+            except asyncio.CancelledError:
+                # Timeout del agente: lo que se teclee hasta el próximo prompt era para esta pregunta
+                self._expired = True
+                raise
+            finally:
+                self._waiter = None
+
+_stdin_broker = _StdinBroker()
 
 class HumanDriver(BaseDriver):
     """
-    Permite interacción por consola. Usa asyncio.to_thread para no bloquear.
+    Permite interacción por consola. Lee stdin a través de un broker compartido para no bloquear.
     """
     async def get_action(self, visible_state: WorldState) -> AgentAction:
-        print(f"\n[HUMANO] Turno de {self.agent_id}. Estado visible:")
-        print(f"  Ubicación: {visible_state.room_id}")
-        print(f"  Entidades: {[e.name for e in visible_state.entities]}")
+        prompt = (
+            f"\n[HUMANO] Turno de {self.agent_id}. Estado visible:\n"
+            f"  Ubicación: {visible_state.room_id}\n"
+            f"  Entidades: {[e.name for e in visible_state.entities]}\n"
+            f"  Acción para {self.agent_id} (TAKE <id> | TALK <msg> | WAIT): "
+        )
         
-        # Ejecutar input() en un thread separado para no bloquear el event loop
-        action_str = await asyncio.to_thread(input, f"  Acción para {self.agent_id} (TAKE <id> | TALK <msg> | WAIT): ")
+        # El estado y la pregunta se imprimen juntos, cuando le toca a este agente
+        action_str = await _stdin_broker.ask(prompt)
         
         parts = action_str.strip().split(" ", 1)
         action_type = parts[0].upper()
@@ -102,6 +271,7 @@ class HumanDriver(BaseDriver):
             return AgentAction(agent_id=self.agent_id, action_type="WAIT")
 
     async def receive_feedback(self, turn_result: TurnResult):
+        await _drain_log_queue()
         print(f"\n[HUMANO] Feedback para {self.agent_id}:")
         print(f"  Narrativa: {turn_result.narrative}")
 
@@ -110,6 +280,8 @@ class StaticFileDriver(BaseDriver):
     Lee respuestas de archivos JSON locales.
     Ruta: c:/PROYECTOS/IAS/responses/{agent_id}.json
     """
+    deterministic = True
+
     def __init__(self, agent_id: str):
         super().__init__(agent_id)
         self.responses_path = f"responses/{agent_id}.json"
@@ -121,6 +293,26 @@ class StaticFileDriver(BaseDriver):
         if os.path.exists(self.responses_path):
             with open(self.responses_path, 'r', encoding='utf-8') as f:
                 self.responses = json.load(f)
+        
+        # Precompilar: una lista indexada por turno con las AgentAction ya construidas,
+        # en vez de str(turno) + dos búsquedas en el dict + validación Pydantic por turno.
+        per_turn: Dict[int, AgentAction] = {}
+        for key, action_data in self.responses.items():
+            if key.isdigit() and int(key) >= 1 and action_data:
+                per_turn[int(key)] = self._to_action(action_data)
+        
+        self._per_turn: List[Optional[AgentAction]] = [per_turn.get(turn) for turn in range(1, max(per_turn, default=0) + 1)]
+        default_data = self.responses.get("default")
+        self._default: Optional[AgentAction] = self._to_action(default_data) if default_data else None
+        self._no_script = AgentAction(agent_id=self.agent_id, action_type="WAIT", payload={"reason": "No script logic"})
+
+    def _to_action(self, action_data: Dict[str, Any]) -> AgentAction:
+        return AgentAction(
+            agent_id=self.agent_id,
+            action_type=action_data.get("action_type", "WAIT"),
+            target_id=action_data.get("target_id"),
+            payload=action_data.get("payload", {})
+        )
 
     async def get_action(self, visible_state: WorldState) -> AgentAction:
         # Intentar obtener respuesta para el turno actual (o "default")
@@ -129,18 +321,9 @@ class StaticFileDriver(BaseDriver):
         # Usaremos un contador interno por ahora.
         self.current_turn += 1
         
-        turn_key = str(self.current_turn)
-        action_data = self.responses.get(turn_key) or self.responses.get("default")
-        
-        if action_data:
-            return AgentAction(
-                agent_id=self.agent_id,
-                action_type=action_data.get("action_type", "WAIT"),
-                target_id=action_data.get("target_id"),
-                payload=action_data.get("payload", {})
-            )
-        
-        return AgentAction(agent_id=self.agent_id, action_type="WAIT", payload={"reason": "No script logic"})
+        index = self.current_turn - 1
+        action = self._per_turn[index] if index < len(self._per_turn) else None
+        return action or self._default or self._no_script
 
     async def receive_feedback(self, turn_result: TurnResult):
         pass
@@ -148,6 +331,8 @@ class ScriptedDriver(BaseDriver):
     """
     Ejecuta una secuencia estricta de acciones. Bueno para pruebas.
     """
+    deterministic = True
+
     def __init__(self, agent_id: str, script: List[AgentAction]):
         super().__init__(agent_id)
         self.script = script
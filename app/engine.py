@@ -2,30 +2,41 @@ import asyncio
 import json
 import uuid
 import logging
-from typing import Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 from .models import WorldState, AgentAction, TurnResult
 from .db import DatabaseLog
 from .db import DatabaseLog
 from .drivers import BaseDriver, MockAIDriver, ScriptedDriver, APIDriver, HumanDriver, StaticFileDriver
 from .drivers import BaseDriver, MockAIDriver, ScriptedDriver, APIDriver, HumanDriver, StaticFileDriver
 from .arbitrator import MockArbitrator, LLMArbitrator
+from .ai_config import AIConfig
+from litellm import Router
 
 logger = logging.getLogger(__name__)
 
 class SimulationEngine:
-    def __init__(self, db_path: str = "simulation.db", arbitrator_type: str = "mock", ai_config: dict = None):
+    def __init__(self, db_path: str = "simulation.db", arbitrator_type: str = "mock", ai_config: Optional[AIConfig] = None, max_llm_concurrency: int = 8, router: Optional[Router] = None):
         self.db = DatabaseLog(db_path)
-        self.ai_config = ai_config or {}
+        self.ai_config = ai_config or AIConfig()
+        # Router opcional de LiteLLM (reintentos ante 429), compartido por árbitro y agentes
+        self.router = router
         
         if arbitrator_type == "llm" and ai_config:
             self.arbitrator = LLMArbitrator(
-                reasoning_model=ai_config.get("arbitrator_reasoning"),
-                formatting_model=ai_config.get("arbitrator_formatting")
+                reasoning_model=ai_config.arbitrator_reasoning,
+                db=self.db,
+                router=router
             )
         else:
             self.arbitrator = MockArbitrator()
         self.drivers: Dict[str, BaseDriver] = {}
         self.simulation_id = None
+        # Contador de turnos en memoria: se lee de la DB solo al inicializar/reanudar
+        self._next_turn_id: int = 0
+        # Estado del mundo en memoria: la DB solo se lee al inicializar/reanudar
+        self._current_state: Optional[WorldState] = None
+        # Limita las peticiones simultáneas a los proveedores (evita ráfagas de 429)
+        self._llm_sem = asyncio.Semaphore(max_llm_concurrency)
 
     def initialize_simulation(self, config_path: str) -> str:
         """Loads the world_init.json and creates a new simulation."""
@@ -56,10 +67,38 @@ class SimulationEngine:
             inputs={}
         )
         
+        self._next_turn_id = self._get_next_turn_id()
+        self._current_state = initial_state
+        
         # Inicializar Drivers
         self._setup_drivers(initial_state)
         
-        print(f"Simulación inicializada: {sim_id}")
+        logger.info(f"Simulación inicializada: {sim_id}")
+        return sim_id
+
+    def resume_simulation(self, sim_id: str) -> str:
+        """Reanuda una simulación existente desde su último turno guardado."""
+        last_state_dict = self.db.load_last_state(sim_id)
+        if last_state_dict is None:
+            raise ValueError(f"Simulation {sim_id} not found")
+        
+        self.simulation_id = sim_id
+        self._next_turn_id = self._get_next_turn_id()
+        # Estado guardado por nosotros mismos: no hace falta revalidarlo
+        self._current_state = WorldState.from_trusted(last_state_dict)
+        
+        # Inicializar Drivers
+        self._setup_drivers(self._current_state)
+        # Los drivers con guion llevan su propio contador: colocarlo tras los turnos ya jugados
+        # para no repetir el guion desde el turno 1
+        turns_played = self._next_turn_id - 1
+        for driver in self.drivers.values():
+            if isinstance(driver, StaticFileDriver):
+                driver.current_turn = turns_played
+            elif isinstance(driver, ScriptedDriver):
+                driver.step = turns_played
+        
+        logger.info(f"Simulación reanudada: {sim_id} (siguiente turno {self._next_turn_id})")
         return sim_id
 
     def _setup_drivers(self, state: WorldState):
@@ -73,8 +112,8 @@ class SimulationEngine:
                     self.drivers[entity.id] = ScriptedDriver(entity.id, [])
                 elif entity.driver == 'api':
                     # Configuración dinámica por agente
-                    model = self.ai_config.get(f"agent_{entity.id}", self.ai_config.get("agent_default"))
-                    self.drivers[entity.id] = APIDriver(entity.id, model_name=model)
+                    model = self.ai_config.agent_model(entity.id)
+                    self.drivers[entity.id] = APIDriver(entity.id, model_name=model, router=self.router)
                 elif entity.driver == 'human':
                     self.drivers[entity.id] = HumanDriver(entity.id)
                 elif entity.driver == 'static':
@@ -86,56 +125,142 @@ class SimulationEngine:
         if not self.simulation_id:
             raise ValueError("Simulation not initialized")
 
-        # 1. Load generic state (last turn)
-        last_state_dict = self.db.load_last_state(self.simulation_id)
-        current_state = WorldState(**last_state_dict)
-        current_turn_id = self._get_next_turn_id()
+        # 1. Estado actual (en memoria, el del último turno)
+        current_state = self._current_state
+        current_turn_id = self._next_turn_id
 
-        print(f"\n--- Procesando Turno {current_turn_id} ---")
+        logger.info(f"\n--- Procesando Turno {current_turn_id} ---")
 
         # 2. Collect actions (Parallel)
-        agent_actions: List[AgentAction] = []
-        action_coros = []
-        
-        for agent_id, driver in self.drivers.items():
-            # Filter state (Perception Filter - simplified: send all)
-            visible_state = current_state 
-            action_coros.append(driver.get_action(visible_state))
+        agent_actions, inputs_for_log, timeout_events = await self._collect_actions(current_state)
 
-        results = await asyncio.gather(*action_coros, return_exceptions=True)
-        
-        inputs_for_log = {}
-        for res in results:
-            if isinstance(res, AgentAction):
-                agent_actions.append(res)
-                inputs_for_log[res.agent_id] = res.model_dump()
-            else:
-                logger.error(f"Error getting action: {res}")
-
-        # 3. Arbitrate
-        turn_result = self.arbitrator.resolve_turn(
-            current_state, agent_actions, current_turn_id, self.simulation_id
-        )
-
-        # 4. Save to DB
-        self.db.save_turn(turn_result, inputs_for_log)
+        # 3. Arbitrate (async: no bloquea el event loop mientras espera al LLM)
+        async with self._llm_sem:
+            turn_result = await self.arbitrator.aresolve_turn(
+                current_state, agent_actions, current_turn_id, self.simulation_id
+            )
+        turn_result.events.extend(timeout_events)
+        self._current_state = turn_result.world_state
 
-        # 5. Feedback to drivers
+        # 4. Save to DB (en un hilo) solapado con 5. Feedback to drivers
         feedback_coros = [d.receive_feedback(turn_result) for d in self.drivers.values()]
-        await asyncio.gather(*feedback_coros)
+        await asyncio.gather(
+            asyncio.to_thread(self.db.save_turn, turn_result, inputs_for_log),
+            *feedback_coros
+        )
+        self._next_turn_id += 1
         
-        print(f"Turno {current_turn_id} completado. Narrativa: {turn_result.narrative}")
+        logger.info(f"Turno {current_turn_id} completado. Narrativa: {turn_result.narrative}")
         return turn_result
 
     async def run_steps(self, steps: int):
         for _ in range(steps):
             await self.run_turn()
 
+    async def run_steps_batched(self, steps: int):
+        """
+        Igual que run_steps, pero si todos los drivers son deterministas (sus acciones no
+        dependen del estado) precalcula las acciones de los N turnos y el árbitro los
+        resuelve de una vez. Con cualquier otro driver cae al modo turno a turno.
+        """
+        if not self.simulation_id:
+            raise ValueError("Simulation not initialized")
+
+        if steps <= 1 or not self.drivers or not all(d.deterministic for d in self.drivers.values()):
+            await self.run_steps(steps)
+            return
+
+        current_state = self._current_state
+        first_turn_id = self._next_turn_id
+
+        logger.info(f"\n--- Procesando Turnos {first_turn_id}-{first_turn_id + steps - 1} (batch) ---")
+
+        # 1. Desenrollar las acciones de todos los turnos
+        actions_per_turn: List[List[AgentAction]] = []
+        inputs_per_turn: List[Dict[str, Any]] = []
+        events_per_turn: List[List[str]] = []
+        for _ in range(steps):
+            agent_actions, inputs_for_log, timeout_events = await self._collect_actions(current_state)
+            actions_per_turn.append(agent_actions)
+            inputs_per_turn.append(inputs_for_log)
+            events_per_turn.append(timeout_events)
+
+        # 2. Arbitrate (todos los turnos encadenados)
+        async with self._llm_sem:
+            turn_results = await self.arbitrator.aresolve_turns(
+                current_state, actions_per_turn, first_turn_id, self.simulation_id
+            )
+
+        # 3. Save + feedback en orden
+        for turn_result, inputs_for_log, timeout_events in zip(turn_results, inputs_per_turn, events_per_turn):
+            turn_result.events.extend(timeout_events)
+            self._current_state = turn_result.world_state
+            feedback_coros = [d.receive_feedback(turn_result) for d in self.drivers.values()]
+            await asyncio.gather(
+                asyncio.to_thread(self.db.save_turn, turn_result, inputs_for_log),
+                *feedback_coros
+            )
+            self._next_turn_id += 1
+            logger.info(f"Turno {turn_result.turn_id} completado. Narrativa: {turn_result.narrative}")
+
+    async def _collect_actions(self, current_state: WorldState) -> Tuple[List[AgentAction], Dict[str, Any], List[str]]:
+        agent_actions: List[AgentAction] = []
+        timeout_events: List[str] = []
+        timeout = current_state.agent_timeout_seconds
+        # Filter state (Perception Filter - simplified: send all)
+        visible_state = current_state
+
+        async def _bounded(driver: BaseDriver) -> AgentAction:
+            async with self._llm_sem:
+                return await asyncio.wait_for(driver.get_action(visible_state), timeout)
+
+        async def _bounded_batch(drivers: List[APIDriver]) -> List[AgentAction]:
+            async with self._llm_sem:
+                return await asyncio.wait_for(APIDriver.batch_get_actions(drivers, visible_state), timeout)
+
+        # APIDrivers con el mismo modelo van en una sola petición batch; el resto, uno a uno
+        groups: List[List[BaseDriver]] = []
+        api_groups: Dict[str, List[APIDriver]] = {}
+        for driver in self.drivers.values():
+            if isinstance(driver, APIDriver):
+                api_groups.setdefault(driver.model_name, []).append(driver)
+            else:
+                groups.append([driver])
+        groups.extend(api_groups.values())
+
+        results = await asyncio.gather(
+            *(_bounded(g[0]) if len(g) == 1 else _bounded_batch(g) for g in groups),
+            return_exceptions=True
+        )
+
+        # Reordenar por agente (orden de self.drivers) para que el árbitro vea siempre el mismo orden
+        by_agent: Dict[str, Any] = {}
+        for group, res in zip(groups, results):
+            group_results = res if isinstance(res, list) else [res] * len(group)
+            for driver, driver_res in zip(group, group_results):
+                by_agent[driver.agent_id] = driver_res
+        
+        inputs_for_log = {}
+        for agent_id in self.drivers:
+            res = by_agent[agent_id]
+            if isinstance(res, TimeoutError):
+                # Un agente lento no bloquea el turno: pierde su acción y espera
+                logger.warning(f"Timeout ({timeout}s) getting action for {agent_id}")
+                res = AgentAction(agent_id=agent_id, action_type="WAIT", payload={"reason": "timeout"})
+                timeout_events.append(f"timeout_{agent_id}")
+            
+            if isinstance(res, AgentAction):
+                agent_actions.append(res)
+                inputs_for_log[res.agent_id] = res.model_dump()
+            else:
+                logger.error(f"Error getting action: {res}")
+        return agent_actions, inputs_for_log, timeout_events
+
     def _get_next_turn_id(self) -> int:
-        import sqlite3
-        with sqlite3.connect(self.db.db_path) as conn:
-            cursor = conn.execute("SELECT MAX(turn_id) FROM turn_logs WHERE simulation_id = ?", (self.simulation_id,))
-            row = cursor.fetchone()
-            # If no turns yet (only init id 0), next is 1. If init is 0, max is 0, so 0+1=1.
-            return (row[0] if row[0] is not None else -1) + 1
+        # Solo se consulta al inicializar/reanudar; run_turn usa self._next_turn_id.
+        # Si algún día hay varios procesos escribiendo, sustituir por una tabla
+        # turn_counter con UPDATE ... RETURNING.
+        last_turn_id = self.db.get_last_turn_id(self.simulation_id)
+        # If no turns yet (only init id 0), next is 1. If init is 0, max is 0, so 0+1=1.
+        return (last_turn_id if last_turn_id is not None else -1) + 1
 
@@ -0,0 +1,66 @@
+import re
+from typing import Any, Dict, Iterable, Optional
+import orjson
+import litellm
+from litellm import Router
+
+# Primer objeto {...} de la respuesta: rescata el JSON si el modelo lo envolvió en ```json
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.S)
+
+# Proveedores que necesitan un breakpoint explícito para cachear el prefijo.
+# Groq/OpenAI/Gemini cachean prefijos automáticamente si el texto es idéntico turno a turno.
+_EXPLICIT_CACHE_PREFIXES = ("anthropic/", "bedrock/anthropic")
+
+def build_system_message(model: str, text: str) -> Dict[str, Any]:
+    """
+    Mensaje de sistema con el prompt estático. Debe ir SIEMPRE primero y sin contenido
+    dinámico: lo que cambia cada turno va al final, en el mensaje de usuario.
+    """
+    if model.startswith(_EXPLICIT_CACHE_PREFIXES):
+        # Único breakpoint, al final del bloque estático, para cubrir todo el prefijo compartido
+        return {"role": "system", "content": [{
+            "type": "text",
+            "text": text,
+            "cache_control": {"type": "ephemeral"}
+        }]}
+    return {"role": "system", "content": text}
+
+def parse_llm_json(content: str) -> Any:
+    """Parsea la respuesta JSON de un LLM. Lanza orjson.JSONDecodeError si no hay JSON válido."""
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        # Solo se paga el regex cuando el modelo no devolvió JSON puro
+        match = _JSON_OBJECT_RE.search(content or "")
+        if not match:
+            raise
+        return orjson.loads(match.group(0))
+
+async def warm_up(models: Iterable[str]):
+    """
+    Resuelve el proveedor de cada modelo y ejecuta una llamada simulada (sin red), para que
+    la inicialización de LiteLLM no caiga dentro del primer turno de la simulación.
+    """
+    for model in dict.fromkeys(models):
+        litellm.get_llm_provider(model)
+        await litellm.acompletion(
+            model=model,
+            messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1,
+            mock_response="ok"
+        )
+
+def build_router(models: Iterable[str], num_retries: int = 2) -> Router:
+    """
+    Router de LiteLLM con un alias por modelo (el propio nombre del modelo) y reintentos
+    ante 429/errores transitorios del proveedor. Cada alias tiene un único despliegue:
+    no hay nada que repartir, así que se deja la estrategia de enrutado por defecto.
+    """
+    model_list = [{"model_name": model, "litellm_params": {"model": model}} for model in dict.fromkeys(models)]
+    return Router(model_list=model_list, num_retries=num_retries)
+
+async def acompletion(router: Optional[Router] = None, **kwargs) -> Any:
+    """Llamada async a través del Router si lo hay; si no, directamente a LiteLLM."""
+    if router is not None:
+        return await router.acompletion(**kwargs)
+    return await litellm.acompletion(**kwargs)
@@ -26,6 +26,15 @@ class WorldState(BaseModel):
     environment: Environment
     entities: List[Entity]
 
+    @classmethod
+    def from_trusted(cls, data: Dict[str, Any]) -> "WorldState":
+        """Rebuilds a state we serialized ourselves (e.g. from the DB) without re-validating it."""
+        return cls.model_construct(**{
+            **data,
+            "environment": Environment.model_construct(**data["environment"]),
+            "entities": [Entity.model_construct(**e) for e in data["entities"]]
+        })
+
 # --- Actions & Events ---
 
 class AgentAction(BaseModel):
@@ -1,11 +1,21 @@
 import asyncio
 import logging
+import logging.handlers
 import os
+import queue
+import sys
 from dotenv import load_dotenv
 from app.engine import SimulationEngine
 from app.ai_config import AI_CONFIG
+from app.llm import warm_up, build_router
 
-# ... [logging config] ...
+# Logging: los mensajes se encolan y un hilo aparte (QueueListener) los escribe, para que
+# un stdout lento (pipe de CI, logs de Docker) no bloquee el event loop.
+# Van a stdout, como los print de antes: `python main.py > log` sigue funcionando.
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[logging.handlers.QueueHandler(_log_queue)])
+log = logging.getLogger("sandbox")
 
 # Cargar variables de entorno
 load_dotenv()
@@ -14,35 +24,59 @@ load_dotenv()
 import litellm
 litellm.set_verbose = False
 logging.getLogger("LiteLLM").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Configuración
 WORLD_CONFIG = "world_init.json"
 
 async def main():
-    print("Inicializando Project Sandbox MVP (Con LLM Arbitrator Multi-Modelo)...")
+    log.info("Inicializando Project Sandbox MVP (Con LLM Arbitrator Multi-Modelo)...")
     
     # Verificar API Keys
     if not os.getenv("GROQ_API_KEY"):
-        print("ADVERTENCIA: GROQ_API_KEY faltante. Los modelos de Groq fallarán.")
+        log.warning("ADVERTENCIA: GROQ_API_KEY faltante. Los modelos de Groq fallarán.")
     if not os.getenv("GEMINI_API_KEY"):
-        print("ADVERTENCIA: GEMINI_API_KEY faltante. Los modelos de Gemini fallarán.")
+        log.warning("ADVERTENCIA: GEMINI_API_KEY faltante. Los modelos de Gemini fallarán.")
 
-    print(f"Configuración IA Loaded:")
-    print(f"- Cerebro: {AI_CONFIG['arbitrator_reasoning']}")
-    print(f"- Formato: {AI_CONFIG['arbitrator_formatting']}")
+    # Config inmutable (AIConfig congelada): se puede compartir tal cual con el engine
+    reason_model = AI_CONFIG.arbitrator_reasoning
+    models = AI_CONFIG.all_models()
+
+    log.info("Configuración IA Loaded:")
+    log.info(f"- Cerebro: {reason_model}")
+
+    # Calentar LiteLLM antes del primer turno (registro de proveedores, rutas, cliente)
+    await warm_up(models)
+
+    # Router de LiteLLM: reintentos ante 429 y errores transitorios de los modelos configurados.
+    # El engine además limita a 32 las peticiones en vuelo (por debajo del RPM del proveedor).
+    router = build_router(models)
 
     # Inicializar motor con Árbitro LLM y Config
-    engine = SimulationEngine(arbitrator_type="llm", ai_config=AI_CONFIG)
+    engine = SimulationEngine(arbitrator_type="llm", ai_config=AI_CONFIG, max_llm_concurrency=32, router=router)
     
     # Initialize simulation from config
     sim_id = engine.initialize_simulation(WORLD_CONFIG)
-    print(f"ID de Simulación: {sim_id}")
+    log.info(f"ID de Simulación: {sim_id}")
     
-    # Run 5 turns
-    print("Ejecutando 5 turnos...")
-    await engine.run_steps(5)
+    # Run 5 turns (en una sola llamada al árbitro si todos los drivers son deterministas;
+    # con humanos o IAs en juego se resuelven turno a turno)
+    log.info("Ejecutando 5 turnos...")
+    await engine.run_steps_batched(5)
     
-    print("Simulación completada. Revisa 'simulation.db' para ver los resultados.")
+    log.info("Simulación completada. Revisa 'simulation.db' para ver los resultados.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    _log_listener.start()
+    try:
+        # Event loop de libuv (más rápido con muchas llamadas HTTP concurrentes).
+        # No existe en Windows: ahí se usa el loop estándar de asyncio.
+        try:
+            import uvloop
+        except ImportError:
+            asyncio.run(main())
+        else:
+            uvloop.run(main())
+    finally:
+        # Vacía la cola: ningún mensaje se pierde al salir
+        _log_listener.stop()
@@ -0,0 +1,31 @@
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Varios HumanDriver.get_action seguidos leyendo de un stdin por pipe (entrada ya disponible)
+_SCRIPT = """
+import asyncio
+from app.drivers import HumanDriver
+from app.models import WorldState, Environment
+
+async def main():
+    state = WorldState(room_id="sala", environment=Environment(), entities=[])
+    driver = HumanDriver("jugador")
+    for _ in range(4):
+        action = await driver.get_action(state)
+        print("ACTION", action.action_type, action.target_id or "", action.payload.get("message", ""))
+
+asyncio.run(main())
+"""
+
+def test_piped_lines_are_answered_in_order():
+    proc = subprocess.run(
+        [sys.executable, "-c", _SCRIPT],
+        input="TALK hola\nTAKE item_bocadillo_99\nTALK adios\n",
+        capture_output=True, text=True, cwd=ROOT, timeout=30
+    )
+    assert proc.returncode == 0, proc.stderr
+    actions = [line.split(" ", 1)[1].strip() for line in proc.stdout.splitlines() if line.startswith("ACTION")]
+    assert actions == ["TALK  hola", "TAKE item_bocadillo_99", "TALK  adios", "WAIT"]